@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# crs-o-matic - CRS Schedule Generator
+# Copyright (C) 2008-2020  Darwin M. Bautista
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Run many schedule queries from a file
+
+Each query is a block of lines in the same 'course: filters' syntax as the
+web form. Queries are separated by blank lines. One JSON object per query is
+written to stdout, in input order.
+"""
+
+import argparse
+import json
+import operator
+import os
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import reduce
+from urllib.parse import quote
+
+import requests
+
+import crs
+
+
+class PageCache:
+    """Fetches CRS pages once and optionally keeps them as snapshot files
+
+    In offline mode, pages are only read from the snapshot directory.
+    """
+
+    def __init__(self, snapshot_dir=None, offline=False):
+        self.snapshot_dir = snapshot_dir
+        self.offline = offline
+        self._pages = {}
+
+    def _get_path(self, url):
+        name = quote(url[len(crs.URI):].strip('/'), safe='') + '.html'
+        return os.path.join(self.snapshot_dir, name)
+
+    def __call__(self, url):
+        try:
+            return self._pages[url]
+        except KeyError:
+            pass
+        path = self._get_path(url) if self.snapshot_dir else None
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                page = f.read()
+        elif self.offline:
+            raise LookupError('Page not in snapshot: ' + url)
+        else:
+            page = crs.fetch(url)
+            if path is not None:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(page)
+        self._pages[url] = page
+        return page
+
+
+def read_queries(f):
+    """Read blank line-separated blocks of search lines"""
+    query = []
+    for line in f:
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        if line:
+            query.append(line)
+        elif query:
+            yield query
+            query = []
+    if query:
+        yield query
+
+
+def _get_slot_counts(schedules):
+    """Count the schedules occupying each 15-minute time slot
+
+    Classes with the same schedule are merged, so each schedule stands for
+    the product of the number of similar classes in it.
+    """
+    counts = [0] * (len(crs.Constraints.DAYS) * crs.Interval.MAX_BIT_LENGTH)
+    for sched in schedules:
+        weight = reduce(operator.mul, [1 + len(c.similar) for c in sched])
+        enc = reduce(operator.or_, [c._schedule_enc for c in sched])
+        while enc:
+            low = enc & -enc
+            counts[low.bit_length() - 1] += weight
+            enc ^= low
+    n = crs.Interval.MAX_BIT_LENGTH
+    return {day: counts[d * n:(d + 1) * n] for d, day in enumerate(crs.Constraints.DAYS)}
+
+
+def _run(args):
+    classes, top, timeout, limit = args
+    schedules = crs.get_schedules(*classes, timeout=timeout, limit=limit)
+    return {
+        'valid': len(schedules),
+        'truncated': schedules.truncated,
+        'remaining': schedules.remaining,
+        'schedules': [{
+            'id': sched.id,
+            'classes': [{
+                'name': c.name,
+                'sections': sorted([c.section] + [s.section for s in c.similar]),
+                'odds': c.get_odds()
+            } for c in sched]
+        } for sched in schedules[:top]],
+        'heatmap': {
+            'start': '{:02d}:00'.format(crs.Interval.REF_HOUR),
+            'minutes_per_slot': crs.Interval.MINUTES_PER_BIT,
+            'slots': _get_slot_counts(schedules)
+        }
+    }
+
+
+def _search(query, term, fetch):
+    result = {'query': query, 'found': [], 'missing': [], 'units': 0, 'possible': 0}
+    classes = []
+    for line in query:
+        course_num, filters = crs.parse_query(line)
+        c = crs.search(course_num, term, filters, True, fetch)
+        if c:
+            classes.append(c)
+            result['found'].append(c[0].name)
+        else:
+            result['missing'].append(course_num)
+    if classes:
+        result['units'] = crs.get_units(classes)
+        result['possible'] = reduce(operator.mul, [len(c) for c in classes])
+    return result, classes
+
+
+def _output(result, future):
+    try:
+        result.update(future.result())
+    except Exception as e:
+        # Don't let one failed query stop the whole batch
+        result = {'query': result['query'], 'error': str(e) or type(e).__name__}
+    print(json.dumps(result), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+                        help='file with the queries (default: stdin)')
+    parser.add_argument('-t', '--term', help='CRS term code (default: current term)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('-n', '--top', type=int, default=10, help='number of schedules to output per query')
+    parser.add_argument('--limit', type=int, default=10000, help='max number of schedules to search per query')
+    parser.add_argument('--timeout', type=float, default=60, help='max search time per query, in seconds')
+    parser.add_argument('-s', '--snapshot', metavar='DIR',
+                        help='read CRS pages from DIR, saving the pages missing from it')
+    parser.add_argument('--offline', action='store_true', help='only use the pages in the snapshot')
+    args = parser.parse_args(argv)
+    if args.offline and not args.snapshot:
+        parser.error('--offline requires --snapshot')
+    if args.snapshot:
+        os.makedirs(args.snapshot, exist_ok=True)
+
+    fetch = PageCache(args.snapshot, args.offline)
+    if args.term:
+        term = args.term
+    else:
+        try:
+            name, term = crs.get_current_term(fetch)
+        except (LookupError, requests.RequestException) as e:
+            sys.exit('Cannot get the current term ({}); specify it with --term'.format(e))
+
+    with ProcessPoolExecutor(args.jobs) as executor:
+        pending = []
+        for query in read_queries(args.input):
+            # Pages are fetched here so that all the queries share the page cache
+            try:
+                result, classes = _search(query, term, fetch)
+            except (LookupError, requests.RequestException) as e:
+                future = Future()
+                future.set_result({'error': str(e)})
+                pending.append(({'query': query}, future))
+            else:
+                pending.append((result, executor.submit(_run, (classes, args.top, args.timeout, args.limit))))
+            # Output the finished queries while keeping the input order
+            while pending and pending[0][1].done():
+                _output(*pending.pop(0))
+        for result, future in pending:
+            _output(result, future)
+
+
+if __name__ == '__main__':
+    main()
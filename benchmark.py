@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# crs-o-matic - CRS Schedule Generator
+# Copyright (C) 2008-2020  Darwin M. Bautista
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the size and send time of a large result page
+
+Renders index.html for a synthetic query, without contacting CRS, and
+reports the rendering time, then the bytes on the wire and the server send
+time for each content coding.
+"""
+
+import random
+import time
+
+from flask import Flask, render_template
+
+import crs
+from compress import compress
+from filters import filters
+from test_crs import make_class
+
+ROUNDS = 5
+
+
+def _make_classes(num_classes, num_sections, seed=0):
+    rand = random.Random(seed)
+    classes = []
+    for i in range(num_classes):
+        sections = []
+        for j in range(num_sections):
+            hour = rand.randint(7, 18)
+            interval = crs.Interval(crs.Time(hour, 0), crs.Time(hour + 1, 30))
+            slots = [(d, interval) for d in rand.choice([(0, 3), (1, 4), (2, 4)])]
+            stats = (rand.randint(1, 40), 40, rand.randint(0, 80))
+            sections.append(make_class('Course {}'.format(i), 'S{}'.format(j), slots, stats))
+        classes.append(sections)
+    return classes
+
+
+def _make_app():
+    app = Flask(__name__)
+    app.register_blueprint(filters)
+    app.register_blueprint(compress)
+    return app
+
+
+def _render(app, classes, scheds):
+    desired = {
+        'reg': [c[0] for c in classes],
+        'extra': [],
+        'none': [],
+        'units': 3.0 * len(classes),
+        'matches': len(classes),
+        'possible': len(classes[0]) ** len(classes)
+    }
+    with app.test_request_context('/'):
+        return render_template('index.html', sem='Benchmark', desired=desired, scheds=scheds)
+
+
+def main():
+    classes = _make_classes(6, 8)
+    app = _make_app()
+    # The search is the same for every content coding, so do it only once
+    scheds = crs.get_schedules(*classes, limit=2000)
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        page = _render(app, classes, scheds)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    print('{} schedules, rendered in {:.1f} ms'.format(len(scheds), 1000 * elapsed))
+
+    # Serve the rendered page so that only the sending and the encoding are timed
+    app.add_url_rule('/', 'page', lambda: page)
+    client = app.test_client()
+    for encoding in ('identity', 'gzip', 'br'):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            response = client.get('/', headers={'Accept-Encoding': encoding})
+        elapsed = (time.perf_counter() - start) / ROUNDS
+        print('{:<10} {:>10} bytes {:>8.1f} ms  ({})'.format(
+            encoding, len(response.get_data()), 1000 * elapsed, response.headers.get('Content-Encoding', 'identity')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# crs-o-matic - CRS Schedule Generator
+# Copyright (C) 2008-2020  Darwin M. Bautista
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Response compression"""
+
+import gzip
+
+import flask
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+compress = flask.Blueprint('compress', __name__)
+
+# Responses smaller than this are sent as is
+MIN_SIZE = 1024
+
+MIMETYPES = ('text/html', 'text/css', 'text/plain', 'application/javascript', 'application/json')
+
+
+def _encode(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, mode=brotli.MODE_TEXT, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def _choose_encoding(accept_encodings):
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br'
+    if 'gzip' in accept_encodings:
+        return 'gzip'
+    return None
+
+
+@compress.after_app_request
+def compress_response(response):
+    if response.status_code != 200 or response.direct_passthrough or \
+            response.mimetype not in MIMETYPES or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding(flask.request.accept_encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_SIZE:
+        return response
+    response.set_data(_encode(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Strong ETags have to differ between representations
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag('{}-{}'.format(etag, encoding))
+    return response
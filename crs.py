@@ -16,9 +16,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import colorsys
 import hashlib
 import math
+import operator
+import re
 import time
 import requests
 
@@ -27,11 +30,12 @@ from bs4 import BeautifulSoup, SoupStrainer
 import color
 from htmltable import Table
 
-import itertools
+from functools import reduce
 from itertools import chain
 
 URI = 'https://crs.upd.edu.ph'
-HTTP_HEADERS = {'User-Agent': '{} CRS-o-matic/{}'.format(requests.utils.default_user_agent(), 'VER_ABBREV')}
+VERSION = 'VER_ABBREV'
+HTTP_HEADERS = {'User-Agent': '{} CRS-o-matic/{}'.format(requests.utils.default_user_agent(), VERSION)}
 
 
 def _strftime(fmt, t):
@@ -57,6 +61,9 @@ class Time(tuple):
     def __new__(cls, hour, minute):
         return super().__new__(cls, (hour, minute))
 
+    def __getnewargs__(self):
+        return tuple(self)
+
     def __repr__(self):
         return _strftime('%I:%M%p', self).lower()
 
@@ -85,6 +92,9 @@ class Interval(tuple):
     def __new__(cls, start, end):
         return super().__new__(cls, (start, end))
 
+    def __getnewargs__(self):
+        return tuple(self)
+
     def __repr__(self):
         return '<{}-{}>'.format(*self)
 
@@ -125,6 +135,154 @@ class Class:
         return prob
 
 
+class Constraints:
+    """User-imposed restrictions on the generated schedules
+
+    Forbidden time windows and free days are compiled into a single mask
+    that uses the same bit layout as Class._schedule_enc. The daily load and
+    gap limits are in hours.
+    """
+
+    DAYS = ('M', 'T', 'W', 'Th', 'F', 'S')
+
+    # Bit mask covering a single day
+    DAY_MASK = (1 << Interval.MAX_BIT_LENGTH) - 1
+
+    # Time span covered by the bit layout
+    START = Time(Interval.REF_HOUR, 0)
+    END = Time(Interval.REF_HOUR + Interval.MAX_BIT_LENGTH // Interval.BITS_PER_HOUR, 0)
+
+    def __init__(self, earliest=None, latest=None, windows=(), free_days=(), max_daily_load=None, max_gap=None):
+        """Raises ValueError on invalid arguments"""
+        ref, end = self.START, self.END
+        forbidden = 0
+        if earliest is not None:
+            if not ref <= earliest <= end:
+                raise ValueError('Invalid earliest time: {}:{:02d}'.format(*earliest))
+            if earliest > ref:
+                forbidden |= Interval(ref, earliest).encode()
+        if latest is not None:
+            if not ref <= latest <= end:
+                raise ValueError('Invalid latest time: {}:{:02d}'.format(*latest))
+            if latest < end:
+                forbidden |= Interval(latest, end).encode()
+        self.mask = 0
+        for d in range(len(self.DAYS)):
+            self.mask |= forbidden << d * Interval.MAX_BIT_LENGTH
+        for w in windows:
+            self.mask |= self._parse_window(w)
+        for day in free_days:
+            if day not in self.DAYS:
+                raise ValueError('Invalid day: {}'.format(day))
+            d = self.DAYS.index(day)
+            self.mask |= self.DAY_MASK << d * Interval.MAX_BIT_LENGTH
+        self.max_load = self._to_bits(max_daily_load)
+        self.max_gap = self._to_bits(max_gap)
+
+    def __bool__(self):
+        return bool(self.mask) or self.max_load is not None or self.max_gap is not None
+
+    @staticmethod
+    def _to_bits(hours):
+        if hours is None:
+            return None
+        if not 0 <= hours < float('inf'):
+            raise ValueError('Invalid number of hours: {}'.format(hours))
+        return int(hours * Interval.BITS_PER_HOUR)
+
+    @staticmethod
+    def _parse_clock(data):
+        """Parse a time typed by the user, e.g. '1', '1:30', '1PM' or '13:30'
+
+        Returns the hour, minute and 'AM'/'PM' (or None if not given).
+        """
+        match = re.match(r'(\d{1,2})(?::(\d{2}))?([AP]M?)?$', data.upper())
+        if match is None:
+            raise ValueError('Invalid time: ' + data)
+        hour, minute, meridian = match.groups()
+        hour = int(hour)
+        minute = int(minute or 0)
+        if meridian is not None:
+            meridian = meridian.rstrip('M') + 'M'
+            if not 1 <= hour <= 12:
+                raise ValueError('Invalid time: ' + data)
+        if hour > 24 or minute > 59 or hour == 24 and minute:
+            raise ValueError('Invalid time: ' + data)
+        return hour, minute, meridian
+
+    @staticmethod
+    def _to_time(hour, minute, meridian):
+        if meridian is not None:
+            hour = hour % 12 + (12 if meridian == 'PM' else 0)
+        elif 1 <= hour < Interval.REF_HOUR:
+            # Classes are held from 7am to 9pm, so these can only be PM
+            hour += 12
+        return Time(hour, minute)
+
+    @classmethod
+    def _parse_window(cls, data):
+        """Encode a window specified as '<days> <start>-<end>', e.g. 'MWF 12-1PM'
+
+        Times are either in 12-hour format, with an optional AM/PM on each end,
+        or in 24-hour format. Without AM/PM, hours 1 to 6 are taken as PM. A
+        start without AM/PM takes that of the end, as in CRS schedules.
+        """
+        try:
+            days, interval = data.split(None, 1)
+            start, end = interval.replace(' ', '').split('-')
+        except ValueError:
+            raise ValueError('Invalid window: ' + data)
+        start = cls._parse_clock(start)
+        end = cls._parse_clock(end)
+        end_time = cls._to_time(*end)
+        start_time = cls._to_time(*start)
+        if start[2] is None and end[2] is not None and 1 <= start[0] <= 12:
+            start_time = cls._to_time(start[0], start[1], end[2])
+            if start_time >= end_time:
+                start_time = cls._to_time(start[0], start[1], 'AM' if end[2] == 'PM' else 'PM')
+        # Clip to the time span of the bit layout so that it won't spill into the adjacent days
+        start_time = max(start_time, cls.START)
+        end_time = min(end_time, cls.END)
+        if start_time >= end_time:
+            raise ValueError('Invalid window: ' + data)
+        enc = Interval(start_time, end_time).encode()
+        mask = 0
+        for d, day in ClassParser._parse_days(days):
+            mask |= enc << d * Interval.MAX_BIT_LENGTH
+        if not mask:
+            raise ValueError('Invalid days: ' + days)
+        return mask
+
+    @staticmethod
+    def _max_gap(day):
+        """Length of the longest run of free bits between occupied ones"""
+        return max(map(len, bin(day)[2:].rstrip('0').split('1')))
+
+    def allows(self, kls):
+        """Check if the class falls outside the forbidden time slots"""
+        return not kls._schedule_enc & self.mask
+
+    def prune(self, sched, rest=0):
+        """Check if a partial schedule can be discarded
+
+        rest is the union of all time slots the remaining classes could occupy.
+        Only the slots in it can fill the gaps of the partial schedule.
+        """
+        for d in range(len(self.DAYS)):
+            day = (sched >> d * Interval.MAX_BIT_LENGTH) & self.DAY_MASK
+            if not day:
+                continue
+            if self.max_load is not None and bin(day).count('1') > self.max_load:
+                return True
+            if self.max_gap is not None:
+                # Only consider the span between the first and last occupied slots
+                span = ((1 << day.bit_length()) - 1) ^ ((day & -day) - 1)
+                day |= (rest >> d * Interval.MAX_BIT_LENGTH) & span
+                if self._max_gap(day) > self.max_gap:
+                    return True
+        return False
+
+
 class ScheduleConflict(Exception):
     pass
 
@@ -450,7 +608,6 @@ class ClassParser:
     def _parse_sched(data):
         data = data.split()
         sched = {}
-        sched_enc = 0
         for i, block in enumerate(data[1:]):
             if '-' not in block:
                 continue
@@ -459,12 +616,20 @@ class ClassParser:
                 time = ClassParser._parse_time(block)
             except ValueError:
                 continue
-            time_enc = time.encode()
             # Assume that the previous block is valid days
             for d, day in ClassParser._parse_days(data[i]):
-                sched_enc |= time_enc << d * Interval.MAX_BIT_LENGTH
                 sched.setdefault(day, []).append(time)
-        return sched, sched_enc
+        return sched, ClassParser._encode_sched(sched)
+
+    @staticmethod
+    def _encode_sched(sched):
+        """Encode the schedule into its binary representation, one Interval bit layout per day"""
+        sched_enc = 0
+        for day, times in sched.items():
+            d = Constraints.DAYS.index(day)
+            for time in times:
+                sched_enc |= time.encode() << d * Interval.MAX_BIT_LENGTH
+        return sched_enc
 
     @staticmethod
     def _merge_sched(dest, source):
@@ -472,17 +637,46 @@ class ClassParser:
             dest.setdefault(day, []).extend(source[day])
 
 
-def get_current_term():
-    result = requests.get(URI + '/schedule/', headers=HTTP_HEADERS)
+def fetch(url):
+    """Fetch a CRS page"""
+    return requests.get(url, headers=HTTP_HEADERS).text
+
+
+def get_current_term(fetch=fetch):
     tags = SoupStrainer('select')
-    soup = BeautifulSoup(result.text, 'lxml', parse_only=tags)
+    soup = BeautifulSoup(fetch(URI + '/schedule/'), 'lxml', parse_only=tags)
     selected = soup.find(selected='selected')
+    if selected is None:
+        raise LookupError('Current term not found')
     name = selected.text
     value = selected['value']
     return name, value
 
 
-def search(course_num, term=None, filters=(), distinct=False):
+def parse_query(query):
+    """Split a 'course: filter, filter, ...' search line into its parts"""
+    query = query.split(':', 1)
+    if len(query) == 2:
+        course_num, filters = query
+        filters = [i.strip() for i in filters.split(',')]
+    else:
+        course_num = query[0]
+        filters = []
+    course_num = ' '.join(course_num.split())
+    return course_num, filters
+
+
+def is_extra(kls):
+    """Check if the class is a CWTS or PE class, which don't count towards the total units"""
+    return kls.name.startswith('CWTS') or kls.name.startswith('PE ')
+
+
+def get_units(classes):
+    """Total units of the search results, one list of sections per course"""
+    return sum(c[0].credit for c in classes if not is_extra(c[0]))
+
+
+def search(course_num, term=None, filters=(), distinct=False, fetch=fetch):
     """Search using CRS"""
     # For filtering to work, PE classes have to be specified as: PE <number> <code>
     # However, for CRS search to work, the format should be:     PE <number>
@@ -492,11 +686,10 @@ def search(course_num, term=None, filters=(), distinct=False):
         # Include only the first two words, i.e. PE <number>, in the search key
         search_key = ' '.join(course_num.split()[:2])
     if term is None:
-        name, term = get_current_term()
+        name, term = get_current_term(fetch)
     url = '{}/schedule/{}/{}'.format(URI, term, search_key)
-    result = requests.get(url, headers=HTTP_HEADERS)
     parser = ClassParser(course_num, filters)
-    classes = parser.feed(result.text)
+    classes = parser.feed(fetch(url))
     if distinct:
         _merge_similar(classes)
     # Sort by the odds of getting a class
@@ -504,29 +697,278 @@ def search(course_num, term=None, filters=(), distinct=False):
     return classes
 
 
-def get_schedules(*classes):
-    schedules = []
-    for combination in itertools.product(*classes):
+class ScheduleList(list):
+    """List of valid schedules which may be the result of a truncated search
+
+    truncated is set when the search ran out of its time or result budget,
+    and timed_out when it ran out of time. remaining is then the number of
+    combinations left unexplored.
+    """
+
+    def __init__(self, schedules=(), truncated=False, remaining=0, timed_out=False):
+        super().__init__(schedules)
+        self.truncated = truncated
+        self.timed_out = timed_out
+        self.remaining = remaining
+
+
+class ScheduleCache:
+    """Least recently used store of partial schedules
+
+    Maps a list of classes, identified by the time slots of their sections,
+    to the conflict-free combinations of their sections. Each combination is
+    kept as an (occupied time slots, section indices) tuple. Searching for a
+    list of classes starts from the longest list prefix found in the cache,
+    so adding or removing a class only computes the combinations involving
+    the classes which come after it. Removing the first class recomputes
+    everything: the combinations of a longer list cannot simply be projected
+    onto the shorter one, since that would miss the combinations which
+    conflict with every section of the removed class.
+
+    Prefixes with more than _Search.MAX_PARTIAL combinations are remembered,
+    so that repeated searches skip them right away.
+    """
+
+    # Max number of remembered prefixes which failed to build
+    MAX_FAILED = 1000
+
+    def __init__(self, max_entries=200000):
+        self.max_entries = max_entries
+        self._data = collections.OrderedDict()
+        self._size = 0
+        self._failed = collections.OrderedDict()
+
+    def get(self, key):
         try:
-            sched = Schedule(combination)
-        except ScheduleConflict:
-            continue
+            value = self._data[key]
+        except KeyError:
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.max_entries:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._data[key] = value
+        self._size += len(value)
+        while self._size > self.max_entries:
+            key, old = self._data.popitem(last=False)
+            self._size -= len(old)
+
+    def mark_failed(self, key):
+        self._failed[key] = None
+        self._failed.move_to_end(key)
+        if len(self._failed) > self.MAX_FAILED:
+            self._failed.popitem(last=False)
+
+    def failed(self, key):
+        return key in self._failed
+
+
+class _Search:
+    """Depth-first search over the class combinations
+
+    Yields the conflict-free combinations in the same order as
+    itertools.product(). Partial combinations which conflict or violate the
+    constraints are pruned together with all their extensions.
+
+    The search stops early once timeout seconds have elapsed or limit
+    combinations have been yielded, whichever comes first.
+
+    If a ScheduleCache is given, the combinations are instead built one class
+    at a time from the longest cached prefix of the class list, and every
+    intermediate result is cached for later searches. This falls back to the
+    depth-first search once there are more than MAX_PARTIAL combinations or
+    half of the time budget is used up.
+    """
+
+    # Number of search steps between deadline checks
+    CHECK_INTERVAL = 1024
+
+    # Max number of partial combinations to build when using a cache
+    MAX_PARTIAL = 50000
+
+    def __init__(self, classes, constraints=None, timeout=None, limit=None, cache=None):
+        if constraints:
+            classes = [list(filter(constraints.allows, c)) for c in classes]
         else:
-            schedules.append(sched)
-    return schedules
+            constraints = None
+        self.classes = classes
+        self.constraints = constraints
+        self.timeout = timeout
+        self.limit = limit
+        self.cache = cache
+        self.truncated = False
+        self.timed_out = False
+        self._deadline = None
+        self._idx = [0] * len(classes)
+        self._level = 0
+
+    @property
+    def remaining(self):
+        """Number of combinations not yet explored"""
+        if self._level < 0 or not self.classes or not all(self.classes):
+            return 0
+        # Combinations in lexicographic order before the current position
+        done = 0
+        for l in range(self._level + 1):
+            done = done * len(self.classes[l]) + self._idx[l]
+        for cl in self.classes[self._level + 1:]:
+            done *= len(cl)
+        return reduce(operator.mul, map(len, self.classes)) - done
+
+    def __iter__(self):
+        classes = self.classes
+        if not classes or not all(classes):
+            return
+        if self.timeout is not None:
+            self._deadline = time.monotonic() + self.timeout
+        encs = [[c._schedule_enc for c in cl] for cl in classes]
+        if self.cache is not None:
+            partial = self._join(encs)
+            if partial is not None:
+                yield from self._iter_partial(partial)
+                return
+        yield from self._iter_dfs(encs)
+
+    def _join(self, encs):
+        """Build the combinations from the longest cached prefix onwards"""
+        constraints = self.constraints
+        max_load = None if constraints is None else constraints.max_load
+        keys = []
+        for i in range(len(encs)):
+            keys.append((keys[-1] if keys else (max_load,)) + (tuple(encs[i]),))
+        partial = [(0, ())]
+        start = 0
+        for i in reversed(range(len(keys))):
+            cached = self.cache.get(keys[i])
+            if cached is not None:
+                partial = cached
+                start = i + 1
+                break
+        if any(map(self.cache.failed, keys[start:])):
+            return None
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout / 2
+        steps = 0
+        next_check = self.CHECK_INTERVAL
+        for i in range(start, len(encs)):
+            joined = []
+            for sched, idx in partial:
+                steps += len(encs[i])
+                if deadline is not None and steps >= next_check:
+                    next_check = steps + self.CHECK_INTERVAL
+                    # Not remembered as failed, since this depends on the server load
+                    if time.monotonic() > deadline:
+                        return None
+                for j, enc in enumerate(encs[i]):
+                    if sched & enc:
+                        continue
+                    # Gaps can still be filled by the classes not yet joined, so only check the load
+                    if constraints is not None and constraints.prune(sched | enc, -1):
+                        continue
+                    joined.append((sched | enc, idx + (j,)))
+                if len(joined) > self.MAX_PARTIAL:
+                    self.cache.mark_failed(keys[i])
+                    return None
+            partial = joined
+            self.cache.put(keys[i], partial)
+        return partial
+
+    def _iter_partial(self, partial):
+        classes = self.classes
+        constraints = self.constraints
+        deadline = self._deadline
+        count = 0
+        for steps, (sched, idx) in enumerate(partial, 1):
+            if deadline is not None and not steps % self.CHECK_INTERVAL and time.monotonic() > deadline:
+                # Out of time; this combination is not checked yet
+                self._idx = list(idx)
+                self._level = len(classes) - 1
+                self.truncated = self.timed_out = True
+                return
+            if constraints is not None and constraints.prune(sched):
+                continue
+            if count == self.limit:
+                # There is at least one more valid combination
+                self._idx = list(idx)
+                self._level = len(classes) - 1
+                self.truncated = True
+                return
+            yield tuple(classes[l][i] for l, i in enumerate(idx))
+            count += 1
+        self._level = -1
+
+    def _iter_dfs(self, encs):
+        classes = self.classes
+        constraints = self.constraints
+        # rest[i] is the union of all the time slots of classes[i:]
+        rest = [0] * (len(classes) + 1)
+        for i in reversed(range(len(classes))):
+            rest[i] = rest[i + 1] | reduce(operator.or_, encs[i])
+        deadline = self._deadline
+        count = 0
+        steps = 0
+        last = len(classes) - 1
+        idx = self._idx
+        occupied = [0] * len(classes)
+        level = 0
+        while level >= 0:
+            steps += 1
+            if deadline is not None and not steps % self.CHECK_INTERVAL and time.monotonic() > deadline:
+                self._level = level
+                self.truncated = self.timed_out = True
+                return
+            i = idx[level]
+            if i == len(encs[level]):
+                idx[level] = 0
+                level -= 1
+                if level >= 0:
+                    idx[level] += 1
+                continue
+            enc = encs[level][i]
+            sched = occupied[level]
+            if sched & enc or (constraints is not None and constraints.prune(sched | enc, rest[level + 1])):
+                idx[level] += 1
+            elif level == last:
+                if count == self.limit:
+                    # There is at least one more valid combination
+                    self._level = level
+                    self.truncated = True
+                    return
+                yield tuple(classes[l][idx[l]] for l in range(len(classes)))
+                idx[level] += 1
+                count += 1
+            else:
+                level += 1
+                occupied[level] = sched | enc
+        self._level = level
 
 
-def get_schedules2(*classes):
+def get_schedules(*classes, constraints=None, timeout=None, limit=None, cache=None):
+    """Get the valid schedules as a ScheduleList
+
+    The search is bounded by timeout (in seconds) and limit (number of
+    schedules). If either runs out, the schedules found so far are returned.
+    Pass a ScheduleCache to reuse the work done by previous searches.
+    """
+    search = _Search(classes, constraints, timeout, limit, cache)
+    schedules = list(map(Schedule, search))
+    return ScheduleList(schedules, search.truncated, search.remaining, search.timed_out)
+
+
+def get_schedules2(*classes, constraints=None, timeout=None, limit=None, cache=None):
     """Generator version of get_schedules()"""
-    for combination in itertools.product(*classes):
-        try:
-            sched = Schedule(combination)
-        except ScheduleConflict:
-            continue
-        else:
-            yield sched
+    for combination in _Search(classes, constraints, timeout, limit, cache):
+        yield Schedule(combination)
 
 
-def get_heatmap(*classes):
-    heatmap = Heatmap(get_schedules(*classes))
+def get_heatmap(*classes, constraints=None, timeout=None, limit=None, cache=None):
+    schedules = get_schedules(*classes, constraints=constraints, timeout=timeout, limit=limit, cache=cache)
+    heatmap = Heatmap(schedules)
+    heatmap.truncated = schedules.truncated
+    heatmap.timed_out = schedules.timed_out
+    heatmap.remaining = schedules.remaining
     return [heatmap]
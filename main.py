@@ -16,21 +16,36 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import operator
 from functools import reduce
+from itertools import chain
 
-from flask import Flask, render_template, request
+from flask import Flask, make_response, redirect, render_template, request, url_for
 
 import color
 import crs
+from compress import compress
 from filters import filters
 
 
 SEM, TERM = crs.get_current_term()
 
+# Search budget; stay well within the gunicorn worker timeout
+SEARCH_TIMEOUT = 60
+# Only for the list of schedules; the heatmap needs all of them to be correct
+MAX_SCHEDULES = 10000
+
+# Partial schedules of recent searches, shared by all requests served by this worker
+CACHE = crs.ScheduleCache()
+
+# Lifetime of the result pages in the browser and proxy caches, in seconds
+CACHE_MAX_AGE = 300
+
 
 app = Flask(__name__)
 app.register_blueprint(filters)
+app.register_blueprint(compress)
 
 
 def _search(queries, heatmap_mode):
@@ -44,19 +59,11 @@ def _search(queries, heatmap_mode):
     }
     classes = []
     for s in queries:
-        s = s.split(':', 1)
-        if len(s) == 2:
-            course_num, filters = s
-            filters = [i.strip() for i in filters.split(',')]
-        else:
-            course_num = s[0]
-            filters = []
-        course_num = ' '.join(course_num.split())
+        course_num, filters = crs.parse_query(s)
         c = crs.search(course_num, TERM, filters, not heatmap_mode)
         if c:
             classes.append(c)
-            if not c[0].name.startswith('CWTS') and not c[0].name.startswith('PE '):
-                desired['units'] += c[0].credit
+            if not crs.is_extra(c[0]):
                 desired['reg'].append(c[0])
             else:
                 desired['extra'].append(c[0])
@@ -64,30 +71,106 @@ def _search(queries, heatmap_mode):
             c = crs.Class(name=course_num)
             desired['none'].append(c)
     if classes:
+        desired['units'] = crs.get_units(classes)
         desired['matches'] = len(classes)
         desired['possible'] = reduce(operator.mul, [len(c) for c in classes])
     return desired, classes
 
 
+def _get_constraints(form):
+    """Build the constraints, skipping the invalid ones
+
+    Returns the constraints and the list of rejected input values.
+    """
+    kwargs = {'windows': [], 'free_days': []}
+    rejected = []
+    values = []
+    for key in ('earliest', 'latest'):
+        if form.get(key):
+            try:
+                values.append((key, crs.Time(int(form[key]), 0), form[key]))
+            except ValueError:
+                rejected.append(form[key])
+    for key in ('max_daily_load', 'max_gap'):
+        if form.get(key):
+            try:
+                values.append((key, float(form[key]), form[key]))
+            except ValueError:
+                rejected.append(form[key])
+    for w in form.get('windows', '').split('\r\n'):
+        if w.strip():
+            values.append(('windows', [w], w))
+    for day in form.getlist('free_days'):
+        values.append(('free_days', [day], day))
+    for key, value, text in values:
+        try:
+            # Validate each constraint on its own
+            crs.Constraints(**{key: value})
+        except ValueError:
+            rejected.append(text)
+            continue
+        if isinstance(value, list):
+            kwargs[key].extend(value)
+        else:
+            kwargs[key] = value
+    return crs.Constraints(**kwargs), rejected
+
+
+def _get_etag(args, classes):
+    """Strong ETag derived from the query and the version of the class data"""
+    h = hashlib.sha1(crs.VERSION.encode('utf-8'))
+    h.update(repr((TERM, sorted(args.items(multi=True)))).encode('utf-8'))
+    for c in chain.from_iterable(classes):
+        for kls in [c] + c.similar:
+            h.update(repr((kls.code, kls.section, kls._schedule_enc, kls.stats)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _results(args):
+    searchkey = args['searchkey']
+    heatmap_mode = 'heatmap_mode' in args
+    terms = [s for s in searchkey.split('\r\n') if s]
+    constraints, rejected = _get_constraints(args)
+    desired, classes = _search(terms, heatmap_mode)
+    # Revalidation only needs the class data, not the schedules
+    etag = _get_etag(args, classes)
+    # The compressed representations have their own ETags
+    etags = [etag] + ['{}-{}'.format(etag, e) for e in ('gzip', 'br')]
+    matched = list(filter(request.if_none_match.contains, etags))
+    if matched:
+        response = make_response('', 304)
+        response.vary.add('Accept-Encoding')
+        etag = matched[0]
+    else:
+        kwargs = {}
+        if heatmap_mode:
+            scheds = crs.get_heatmap(*classes, constraints=constraints, timeout=SEARCH_TIMEOUT, cache=CACHE) if classes else None
+            kwargs['gradient_start'] = color.rgb_to_hex(crs.Heatmap.get_color(0))
+            kwargs['gradient_end'] = color.rgb_to_hex(crs.Heatmap.get_color(1))
+        else:
+            scheds = crs.get_schedules(*classes, constraints=constraints, timeout=SEARCH_TIMEOUT, limit=MAX_SCHEDULES, cache=CACHE) if classes else None
+        response = make_response(render_template('index.html', sem=SEM, desired=desired, scheds=scheds, heatmap_mode=heatmap_mode, rejected=rejected, **kwargs))
+        # How far a timed out search gets depends on the server load, so the result can't be cached
+        if scheds is not None and (scheds[0] if heatmap_mode else scheds).timed_out:
+            response.cache_control.no_store = True
+            return response
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    return response
+
+
 @app.route('/')
 def get():
+    if 'searchkey' in request.args:
+        return _results(request.args)
     return render_template('index.html', sem=SEM)
 
 
 @app.route('/', methods=['POST'])
 def post():
-    searchkey = request.form['searchkey']
-    heatmap_mode = 'heatmap_mode' in request.form
-    terms = [s for s in searchkey.split('\r\n') if s]
-    desired, classes = _search(terms, heatmap_mode)
-    kwargs = {}
-    if heatmap_mode:
-        scheds = crs.get_heatmap(*classes) if classes else None
-        kwargs['gradient_start'] = color.rgb_to_hex(crs.Heatmap.get_color(0))
-        kwargs['gradient_end'] = color.rgb_to_hex(crs.Heatmap.get_color(1))
-    else:
-        scheds = crs.get_schedules(*classes) if classes else None
-    return render_template('index.html', sem=SEM, desired=desired, scheds=scheds, heatmap_mode=heatmap_mode, **kwargs)
+    # Redirect to the equivalent GET URL so that the results can be cached
+    return redirect(url_for('get', **request.form.to_dict(flat=False)), 303)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# crs-o-matic - CRS Schedule Generator
+# Copyright (C) 2008-2020  Darwin M. Bautista
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import batch
+import crs
+from test_crs import make_class
+
+
+class ReadQueriesTest(unittest.TestCase):
+
+    def test_blocks(self):
+        f = io.StringIO('\n'.join([
+            '# cohort 1',
+            'CS 11',
+            '  Math 21: THR, !THQ  ',
+            '',
+            '',
+            '# cohort 2',
+            'Geog 1',
+            '# PE 2 TN',
+            'CWTS 1',
+            '',
+            '# nothing here',
+            '',
+            'Kas 1',
+        ]))
+        self.assertEqual(list(batch.read_queries(f)), [
+            ['CS 11', 'Math 21: THR, !THQ'],
+            ['Geog 1', 'CWTS 1'],
+            ['Kas 1'],
+        ])
+
+    def test_empty(self):
+        self.assertEqual(list(batch.read_queries(io.StringIO('\n# comment\n\n'))), [])
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.snapshot_dir = self._dir.name
+        self.url = '{}/schedule/1231/CS 11'.format(crs.URI)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_offline(self):
+        cache = batch.PageCache(self.snapshot_dir, offline=True)
+        with open(cache._get_path(self.url), 'w', encoding='utf-8') as f:
+            f.write('<table></table>')
+        with mock.patch('crs.fetch') as fetch:
+            self.assertEqual(cache(self.url), '<table></table>')
+            # Served from memory afterwards
+            os.remove(cache._get_path(self.url))
+            self.assertEqual(cache(self.url), '<table></table>')
+            with self.assertRaises(LookupError):
+                cache(crs.URI + '/schedule/1231/Math 21')
+            fetch.assert_not_called()
+
+    def test_save_snapshot(self):
+        cache = batch.PageCache(self.snapshot_dir)
+        with mock.patch('crs.fetch', return_value='<table></table>') as fetch:
+            self.assertEqual(cache(self.url), '<table></table>')
+            self.assertEqual(cache(self.url), '<table></table>')
+            fetch.assert_called_once_with(self.url)
+        offline = batch.PageCache(self.snapshot_dir, offline=True)
+        self.assertEqual(offline(self.url), '<table></table>')
+
+
+class SlotCountsTest(unittest.TestCase):
+
+    def test_weighted_by_similar(self):
+        monday = crs.Interval(crs.Time(7, 0), crs.Time(8, 0))
+        tuesday = crs.Interval(crs.Time(8, 0), crs.Time(8, 30))
+        a = make_class('A', 'S1', [(0, monday)])
+        # Same schedule as A S1, so it is merged into it
+        a.similar.append(make_class('A', 'S2', [(0, monday)]))
+        b = make_class('B', 'S1', [(1, tuesday)])
+        c = make_class('B', 'S2', [(0, crs.Interval(crs.Time(20, 45), crs.Time(21, 0)))])
+        counts = batch._get_slot_counts([crs.Schedule((a, b)), crs.Schedule((a, c))])
+        self.assertEqual(set(counts), set(crs.Constraints.DAYS))
+        self.assertTrue(all(len(v) == crs.Interval.MAX_BIT_LENGTH for v in counts.values()))
+        # 7-8am on Monday, in both schedules, each standing for two
+        self.assertEqual(counts['M'][:4], [4] * 4)
+        self.assertEqual(counts['M'][-1], 2)
+        self.assertEqual(sum(counts['M']), 4 * 4 + 2)
+        # 8-8:30am on Tuesday, in the first schedule only
+        self.assertEqual(counts['T'][4:6], [2, 2])
+        self.assertEqual(sum(counts['T']), 4)
+        self.assertEqual(sum(map(sum, counts.values())), 4 * 4 + 2 + 4)
+
+
+class OutputTest(unittest.TestCase):
+
+    def _output(self, result, future):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            batch._output(result, future)
+        return json.loads(out.getvalue())
+
+    def test_result(self):
+        future = Future()
+        future.set_result({'valid': 3})
+        self.assertEqual(self._output({'query': ['CS 11']}, future), {'query': ['CS 11'], 'valid': 3})
+
+    def test_worker_error(self):
+        future = Future()
+        future.set_exception(MemoryError())
+        self.assertEqual(self._output({'query': ['CS 11'], 'found': ['CS 11']}, future),
+                         {'query': ['CS 11'], 'error': 'MemoryError'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+#
+# crs-o-matic - CRS Schedule Generator
+# Copyright (C) 2008-2020  Darwin M. Bautista
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import operator
+import random
+import time
+import unittest
+from functools import reduce
+
+import crs
+
+
+def make_class(name, section, slots, stats=(10, 40, 20)):
+    """Make a class occupying the given (day index, Interval) time slots"""
+    kls = crs.Class(code='{} {}'.format(name, section), name=name, section=section)
+    kls.credit = 3.0
+    kls.stats = stats
+    kls.schedule = {}
+    for d, interval in slots:
+        kls.schedule.setdefault(crs.Constraints.DAYS[d], []).append(interval)
+    kls._schedule_enc = crs.ClassParser._encode_sched(kls.schedule)
+    return kls
+
+
+def _make_sections(name, num_sections, day, hour):
+    """Sections alternating between two adjacent hours on the same day"""
+    sections = []
+    for j in range(num_sections):
+        h = hour + j % 2
+        sections.append(make_class(name, 'S{}'.format(j), [(day, crs.Interval(crs.Time(h, 0), crs.Time(h + 1, 0)))]))
+    return sections
+
+
+def _random_sections(rand, name):
+    """Sections meeting twice a week, at random quarter hours"""
+    sections = []
+    for j in range(rand.randint(2, 8)):
+        slots = []
+        for d in rand.sample(range(6), 2):
+            start = rand.randint(7 * 4, 18 * 4)
+            end = start + rand.choice([4, 6, 8, 12])
+            slots.append((d, crs.Interval(crs.Time(*divmod(start * 15, 60)), crs.Time(*divmod(end * 15, 60)))))
+        sections.append(make_class(name, 'S{}'.format(j), slots))
+    return sections
+
+
+def _rank(classes, combination):
+    """Position of the combination in itertools.product() order"""
+    rank = 0
+    for sections, kls in zip(classes, combination):
+        rank = rank * len(sections) + sections.index(kls)
+    return rank
+
+
+class MakeClassTest(unittest.TestCase):
+
+    def test_matches_parser(self):
+        schedule, schedule_enc = crs.ClassParser._parse_sched('THQ lec TTh 10-11:30AM lab F 1-4PM')
+        slots = [(1, crs.Interval(crs.Time(10, 0), crs.Time(11, 30))),
+                 (3, crs.Interval(crs.Time(10, 0), crs.Time(11, 30))),
+                 (4, crs.Interval(crs.Time(13, 0), crs.Time(16, 0)))]
+        kls = make_class('Geog 1', 'THQ', slots)
+        self.assertEqual(kls.schedule, schedule)
+        self.assertEqual(kls._schedule_enc, schedule_enc)
+
+
+def _minutes(t):
+    return t[0] * 60 + t[1]
+
+
+class ConstraintsTest(unittest.TestCase):
+
+    # Blocked windows, with the days and minutes of the day they cover
+    WINDOWS = [
+        ('MWF 12-1PM', 'M W F', 12 * 60, 13 * 60),
+        ('TTh 10-11:30', 'T Th', 10 * 60, 11 * 60 + 30),
+        ('S 7AM-9PM', 'S', 7 * 60, 21 * 60),
+        ('Th 1-2', 'Th', 13 * 60, 14 * 60),
+        ('W 16:30-18:00', 'W', 16 * 60 + 30, 18 * 60),
+    ]
+
+    def _satisfies(self, schedule, earliest, latest, windows, free_days, max_daily_load, max_gap):
+        """Check the constraints on a complete schedule, in minutes"""
+        for day in crs.Constraints.DAYS:
+            intervals = sorted((_minutes(s), _minutes(e)) for c in schedule for s, e in c.schedule.get(day, []))
+            if not intervals:
+                continue
+            if day in free_days:
+                return False
+            for s, e in intervals:
+                if earliest is not None and s < earliest * 60 or latest is not None and e > latest * 60:
+                    return False
+                for _, days, ws, we in windows:
+                    if day in days.split() and s < we and e > ws:
+                        return False
+            if max_daily_load is not None and sum(e - s for s, e in intervals) > max_daily_load * 60:
+                return False
+            if max_gap is not None:
+                end = intervals[0][1]
+                for s, e in intervals[1:]:
+                    if s - end > max_gap * 60:
+                        return False
+                    end = max(end, e)
+        return True
+
+    def test_matches_post_filter(self):
+        rand = random.Random(1)
+        for _ in range(400):
+            classes = [_random_sections(rand, 'C{}'.format(i)) for i in range(rand.randint(1, 4))]
+            earliest = rand.choice([None, 8, 9, 10])
+            latest = rand.choice([None, 16, 18])
+            windows = rand.sample(self.WINDOWS, rand.randint(0, 2))
+            free_days = rand.sample(crs.Constraints.DAYS, rand.randint(0, 1))
+            max_daily_load = rand.choice([None, 2, 3.5, 5])
+            max_gap = rand.choice([None, 0, 0.5, 1.5, 3])
+            constraints = crs.Constraints(
+                earliest=None if earliest is None else crs.Time(earliest, 0),
+                latest=None if latest is None else crs.Time(latest, 0),
+                windows=[w[0] for w in windows], free_days=free_days,
+                max_daily_load=max_daily_load, max_gap=max_gap)
+            expected = []
+            for combination in itertools.product(*classes):
+                try:
+                    schedule = crs.Schedule(combination)
+                except crs.ScheduleConflict:
+                    continue
+                if self._satisfies(schedule, earliest, latest, windows, free_days, max_daily_load, max_gap):
+                    expected.append(schedule)
+            self.assertEqual(crs.get_schedules(*classes, constraints=constraints), expected)
+
+    def test_parse_window(self):
+        parse = crs.Constraints._parse_window
+        # Equivalent ways to write the same window
+        for a, b in [('Th 1-2', 'Th 1PM-2PM'), ('Th 1-2', 'Th 13:00-14:00'), ('S 12:30-1', 'S 12:30PM-1PM'),
+                     ('TTh 10-11:30', 'TTh 10AM-11:30AM'), ('T 7-9PM', 'T 19-21'), ('W 11-1PM', 'W 11AM-1PM'),
+                     ('M 7AM-9PM', 'M 7 AM - 9 PM')]:
+            self.assertEqual(parse(a), parse(b), a)
+        day = crs.Constraints.DAY_MASK
+        self.assertEqual(parse('M 7AM-9PM'), day)
+        self.assertEqual(parse('MWF 12-1PM') >> 2 * crs.Interval.MAX_BIT_LENGTH & day, parse('M 12-1PM'))
+
+    def test_parse_window_clipped(self):
+        parse = crs.Constraints._parse_window
+        # Must not spill into Tuesday morning
+        self.assertEqual(parse('M 8-10PM'), parse('M 8-9PM'))
+        self.assertEqual(parse('M 8-10PM') >> crs.Interval.MAX_BIT_LENGTH, 0)
+        self.assertEqual(parse('T 6AM-8AM'), parse('T 7AM-8AM'))
+
+    def test_parse_window_invalid(self):
+        for window in ['X 1-2', 'M 25-26', 'M 13PM-2', 'M 1:75-2', 'M 5-6AM', 'M 2-1', 'M', 'M abc', 'M 1-2-3']:
+            with self.assertRaises(ValueError, msg=window):
+                crs.Constraints._parse_window(window)
+
+    def test_invalid(self):
+        for kwargs in [{'free_days': ['X']}, {'max_gap': float('nan')}, {'max_daily_load': float('inf')},
+                       {'max_gap': -1}, {'earliest': crs.Time(25, 0)}, {'latest': crs.Time(6, 0)}]:
+            with self.assertRaises(ValueError, msg=kwargs):
+                crs.Constraints(**kwargs)
+
+
+class TimeBudgetTest(unittest.TestCase):
+
+    TIMEOUT = 0.5
+    # Allowance for the deadline checks and building the results
+    MARGIN = 0.5
+
+    def _check_bounded(self, classes, constraints=None, cache=None):
+        start = time.monotonic()
+        schedules = crs.get_schedules(*classes, constraints=constraints, timeout=self.TIMEOUT, cache=cache)
+        elapsed = time.monotonic() - start
+        self.assertLess(elapsed, self.TIMEOUT + self.MARGIN)
+        self.assertTrue(schedules.truncated)
+        self.assertTrue(schedules)
+        # The partial result is the in-order prefix of the full result
+        self.assertEqual(schedules, crs.get_schedules(*classes, constraints=constraints, limit=len(schedules)))
+        # Everything after the last schedule found may still be unexplored
+        total = reduce(operator.mul, map(len, classes))
+        self.assertGreater(schedules.remaining, 0)
+        self.assertLess(schedules.remaining, total - _rank(classes, schedules[-1]))
+
+    def _pathological(self):
+        # 6^14 combinations, a fraction of which are valid
+        return [_make_sections('C{}'.format(i), 6, i % 6, 7 + 2 * (i // 6)) for i in range(14)]
+
+    def _large_last_class(self, num_sections):
+        classes = [_make_sections('C{}'.format(i), 14, i, 8) for i in range(4)]
+        classes.append(_make_sections('Z', num_sections, 5, 10))
+        return classes
+
+    def test_pathological(self):
+        self._check_bounded(self._pathological())
+
+    def test_pathological_cache(self):
+        cache = crs.ScheduleCache()
+        self._check_bounded(self._pathological(), cache=cache)
+        # Repeating the query must not redo the failed work
+        self._check_bounded(self._pathological(), cache=cache)
+
+    def test_large_last_class_cache(self):
+        constraints = crs.Constraints(max_gap=0)
+        for num_sections in (60, 600):
+            cache = crs.ScheduleCache()
+            self._check_bounded(self._large_last_class(num_sections), constraints, cache)
+            self._check_bounded(self._large_last_class(num_sections), constraints, cache)
+
+    def test_limit(self):
+        classes = [_make_sections('C{}'.format(i), 4, i % 2, 8) for i in range(4)]
+        valid = []
+        for combination in itertools.product(*classes):
+            try:
+                valid.append(crs.Schedule(combination))
+            except crs.ScheduleConflict:
+                pass
+        total = reduce(operator.mul, map(len, classes))
+        for cache in (None, crs.ScheduleCache()):
+            for limit in range(1, len(valid)):
+                schedules = crs.get_schedules(*classes, limit=limit, cache=cache)
+                self.assertEqual(schedules, valid[:limit])
+                self.assertTrue(schedules.truncated)
+                # Counted from the first valid schedule left out
+                self.assertEqual(schedules.remaining, total - _rank(classes, valid[limit]))
+            schedules = crs.get_schedules(*classes, limit=len(valid), cache=cache)
+            self.assertEqual(schedules, valid)
+            self.assertFalse(schedules.truncated)
+            self.assertEqual(schedules.remaining, 0)
+
+
+class IncrementalSearchTest(unittest.TestCase):
+
+    def test_matches_uncached(self):
+        rand = random.Random(0)
+        pool = [_random_sections(rand, 'C{}'.format(i)) for i in range(10)]
+        constraints = [
+            None,
+            crs.Constraints(earliest=crs.Time(8, 0), max_daily_load=5, max_gap=1.5),
+            crs.Constraints(free_days=['S'], max_gap=1),
+        ]
+        cache = crs.ScheduleCache()
+        query = rand.sample(pool, 3)
+        for _ in range(200):
+            # Add, remove or swap a class, as in an interactive session
+            action = rand.choice(['add', 'remove', 'swap'])
+            if action == 'add' and len(query) < 7 or len(query) < 2:
+                query.insert(rand.randint(0, len(query)), rand.choice(pool))
+            elif action == 'remove':
+                query.pop(rand.randrange(len(query)))
+            else:
+                query[rand.randrange(len(query))] = rand.choice(pool)
+            c = rand.choice(constraints)
+            limit = rand.choice([None, None, 3, 50])
+            expected = crs.get_schedules(*query, constraints=c, limit=limit)
+            schedules = crs.get_schedules(*query, constraints=c, limit=limit, cache=cache)
+            self.assertEqual(schedules, expected)
+            self.assertEqual(schedules.truncated, expected.truncated)
+            self.assertEqual(schedules.remaining, expected.remaining)
+
+
+    def test_timeout_not_remembered(self):
+        # Small enough to build, but not within a zero time budget
+        classes = [_make_sections('C{}'.format(i), 40, i, 8) for i in range(3)]
+        cache = crs.ScheduleCache()
+        schedules = crs.get_schedules(*classes, timeout=0, cache=cache)
+        self.assertTrue(schedules.timed_out)
+        self.assertFalse(cache._failed)
+        self.assertEqual(crs.get_schedules(*classes, cache=cache), crs.get_schedules(*classes))
+        self.assertTrue(cache._data)
+
+
+if __name__ == '__main__':
+    unittest.main()